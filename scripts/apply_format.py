@@ -1,58 +1,113 @@
 #!/usr/bin/env python3
+import argparse
 import os
-import subprocess
 import sys
+import time
 
-# 配置
-SOURCE_DIRS = ["src"]
-EXTENSIONS = (".cpp", ".h", ".hpp", ".cc", ".cxx")
-
-# ============================================================
-# 动态查找当前 Python 环境下的 clang-format 可执行文件
-# ============================================================
-def find_clang_format():
-    bin_dir = os.path.dirname(sys.executable)
-    executable_name = "clang-format.exe" if os.name == 'nt' else "clang-format"
-    target_path = os.path.join(bin_dir, executable_name)
-    
-    if os.path.exists(target_path):
-        return [target_path]
-    else:
-        return ["clang-format"]
+from format_common import (
+    CLANG_FORMAT_CMD,
+    CPU_COUNT,
+    SOURCE_DIRS,
+    clang_format_version,
+    config_hash,
+    file_hash,
+    iter_sources,
+    load_cache,
+    load_last_run,
+    modified_since,
+    run_clang_format,
+    run_pipeline,
+    save_cache,
+    save_last_run,
+)
+
+def format_files(batch, cache, cfg_hash):
+    # 在消费者线程中执行: 跳过缓存命中的文件，其余文件交给一次 clang-format 调用
+    chunk = []
+    cache_hits = 0
+    for file_path in batch:
+        if cache.get(file_path) == file_hash(file_path, cfg_hash):
+            cache_hits += 1
+        else:
+            chunk.append(file_path)
+    if not chunk:
+        return chunk, 0, {}, cache_hits
 
-CLANG_FORMAT_CMD = find_clang_format()
-# ============================================================
+    returncode = run_clang_format(["-i", "-style=file"] + chunk).returncode
+    formatted_ns = time.time_ns()
+    if returncode != 0:
+        return chunk, returncode, {}, cache_hits
 
-def apply_format():
+    # 记录格式化后的内容哈希，下次运行时内容未变即可跳过。
+    # 仅缓存稳定的文件: 哈希前后 mtime 一致，且不晚于 clang-format 返回的时刻；
+    # 否则说明文件在格式化之后又被改写 (例如编辑器保存)，其内容未必已格式化
+    hashes = {}
+    for file_path in chunk:
+        before = os.stat(file_path).st_mtime_ns
+        digest = file_hash(file_path, cfg_hash)
+        after = os.stat(file_path).st_mtime_ns
+        if before == after and after <= formatted_ns:
+            hashes[file_path] = digest
+    return chunk, returncode, hashes, cache_hits
+
+def apply_format(force=False, jobs=CPU_COUNT):
+    start_time = time.time()
     try:
-        subprocess.check_output(CLANG_FORMAT_CMD + ["--version"])
+        version_output = clang_format_version()
     except Exception:
         print("错误: 无法执行 clang-format。")
         sys.exit(1)
 
     print(f"正在应用代码格式化 (使用 {CLANG_FORMAT_CMD[0]})...")
     
+    cfg_hash = config_hash(version_output)
+    cache = {} if force else load_cache()
+    last_run = 0 if force else load_last_run(cfg_hash)
+    skipped = 0
+
+    def sources():
+        # mtime/ctime 未变的文件不必读取；变了但内容未变时由消费者中的哈希兜底
+        nonlocal skipped
+        for source_dir in SOURCE_DIRS:
+            for file_path in iter_sources(source_dir):
+                if not modified_since(file_path, last_run):
+                    skipped += 1
+                    continue
+                yield file_path
+
+    # 边遍历边分批交给 clang-format，避免每个文件都付出一次进程启动和配置解析的开销
     count = 0
-    for source_dir in SOURCE_DIRS:
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                if file.endswith(EXTENSIONS):
-                    file_path = os.path.join(root, file)
-                    print(f"正在格式化: {file_path}")
-                    
-                    try:
-                        subprocess.check_call(
-                            CLANG_FORMAT_CMD + ["-i", "-style=file", file_path]
-                        )
-                        count += 1
-                    except subprocess.CalledProcessError:
-                        print(f"格式化文件失败: {file_path}")
-                        sys.exit(1)
+    failed = []
+    for chunk, returncode, hashes, cache_hits in run_pipeline(
+            sources(), lambda batch: format_files(batch, cache, cfg_hash), jobs):
+        skipped += cache_hits
+        if returncode != 0:
+            failed.extend(chunk)
+            continue
+        for file_path in chunk:
+            print(f"正在格式化: {file_path}")
+        count += len(chunk)
+        cache.update(hashes)
+
+    save_cache(cache)
+    if failed:
+        print(f"格式化文件失败: {', '.join(failed)}")
+        sys.exit(1)
+    save_last_run(cfg_hash, start_time)
 
     print("\n" + "="*40)
-    print(f"完成! 已处理 {count} 个文件。")
+    print(f"完成! 已处理 {count} 个文件，跳过 {skipped} 个未变化的文件。")
     print("="*40)
 
 if __name__ == "__main__":
-    apply_format()
+    parser = argparse.ArgumentParser(description="使用 clang-format 格式化源代码")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略增量缓存和上次运行时间戳，处理所有文件")
+    parser.add_argument("-j", "--jobs", type=int, default=CPU_COUNT, metavar="N",
+                        help=f"并行执行 clang-format 的任务数 (默认 CPU 核数 {CPU_COUNT})；"
+                             f"--jobs 1 即顺序执行，便于调试")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs 必须大于等于 1")
+    apply_format(force=args.force, jobs=args.jobs)
 
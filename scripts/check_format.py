@@ -1,40 +1,183 @@
 #!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import difflib
 import os
+import re
 import subprocess
 import sys
-import difflib
+import time
+from xml.etree import ElementTree
 
-# =================配置区域=================
-SOURCE_DIRS = ["src"]
-EXTENSIONS = (".cpp", ".h", ".hpp", ".cc", ".cxx")
+from format_common import (
+    CLANG_FORMAT_CMD,
+    CONFIG_FILE,
+    CPU_COUNT,
+    EXT_SET,
+    SOURCE_DIRS,
+    clang_format_version,
+    config_hash,
+    file_hash,
+    iter_sources,
+    load_cache,
+    load_last_run,
+    modified_since,
+    run_clang_format,
+    run_pipeline,
+    save_cache,
+    save_last_run,
+)
 
-# ============================================================
-# 核心逻辑：动态查找当前 Python 环境下的 clang-format 可执行文件
-# ============================================================
-def find_clang_format():
-    # 1. 获取当前 Python 解释器的目录 (例如 .../venv/bin)
-    bin_dir = os.path.dirname(sys.executable)
-    
-    # 2. 拼接 clang-format 的路径
-    executable_name = "clang-format.exe" if os.name == 'nt' else "clang-format"
-    target_path = os.path.join(bin_dir, executable_name)
-    
-    # 3. 如果存在 (pip 安装版)，就使用绝对路径；否则回退到系统 PATH
-    if os.path.exists(target_path):
-        return [target_path]
-    else:
-        return ["clang-format"]
+# clang-format --dry-run 诊断信息的前缀: "path:line:col: "
+DIAGNOSTIC_RE = re.compile(r'^(.+?):\d+:\d+: ')
+# Diff 着色: 仅在输出到终端且未设置 NO_COLOR 时启用 (可用 --color 覆盖)
+USE_COLOR = sys.stdout.isatty() and os.environ.get('NO_COLOR') is None
+DIFF_COLORS = {b'-': b'\033[31m', b'+': b'\033[32m', b'@': b'\033[36m'}
+
+def changed_files(base):
+    # 只取相对 base 的 merge-base 新增/修改/重命名的文件 (PR 场景)；包含删除项仅用于发现
+    # .clang-format 被删除，已删除的源文件会被下面的 isfile 过滤掉。
+    # .clang-format 本身有改动时返回 None，由调用方回退到全量检查
+    try:
+        # -z: 以 NUL 分隔且不对非 ASCII 路径加引号转义 (core.quotePath)
+        output = subprocess.check_output(
+            ["git", "diff", "-z", "--name-only", "--diff-filter=ACMRD", f"{base}...HEAD"]
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"错误: 无法获取相对 {base} 的改动文件列表。")
+        print(f"调试信息: {e}")
+        sys.exit(1)
+
+    files = []
+    for name in output.split(b'\0'):
+        if not name:
+            continue
+        file_path = os.path.normpath(os.fsdecode(name))
+        if file_path == CONFIG_FILE:
+            return None
+        in_source_dir = any(
+            file_path.startswith(source_dir + os.sep) for source_dir in SOURCE_DIRS
+        )
+        if in_source_dir and file_path[file_path.rfind('.'):] in EXT_SET and os.path.isfile(file_path):
+            files.append(file_path)
+    return files
+
+def dry_run_files(chunk):
+    # 快速路径: 由 clang-format 自身判断是否需要格式化，干净的文件无需在 Python 侧读取和对比
+    result = run_clang_format(
+        ["--dry-run", "--Werror", "-style=file"] + chunk,
+        capture_output=True
+    )
+    if result.returncode == 0:
+        return []
+
+    # 从诊断信息的 "path:line:col:" 前缀中解析出不合规的文件
+    chunk_set = set(chunk)
+    failed = set()
+    for line in result.stderr.decode('utf-8', errors='replace').splitlines():
+        match = DIAGNOSTIC_RE.match(line)
+        if match and match.group(1) in chunk_set:
+            failed.add(match.group(1))
+
+    # 无法解析时 (例如 clang-format 自身出错)，整批回退到逐文件检查
+    return [f for f in chunk if f in failed] if failed else chunk
+
+def check_batch(batch, cache, cfg_hash):
+    # 在消费者线程中执行: 计算内容哈希，跳过缓存命中的文件，其余文件一次 dry-run
+    digests = {file_path: file_hash(file_path, cfg_hash) for file_path in batch}
+    pending = [f for f in batch if cache.get(f) != digests[f]]
+    return digests, dry_run_files(pending) if pending else []
+
+def apply_replacements(original_bytes, replacements):
+    # 按偏移量顺序拼接: 未改动的原始片段 + 替换文本
+    pieces = []
+    pos = 0
+    for offset, length, text in replacements:
+        pieces.append(original_bytes[pos:offset])
+        pieces.append(text)
+        pos = offset + length
+    pieces.append(original_bytes[pos:])
+    return b''.join(pieces)
+
+def format_to_stdout(file_path):
+    # 获取完整的格式化后内容 (不修改文件，只输出到 stdout)，与原始字节直接对比
+    formatted_bytes = run_clang_format(
+        ["-style=file", file_path], check=True, stdout=subprocess.PIPE
+    ).stdout
+    with open(file_path, 'rb') as f:
+        original_bytes = f.read()
+    return file_path, original_bytes, formatted_bytes
 
-CLANG_FORMAT_CMD = find_clang_format()
+def check_file(file_path):
+    # 慢速路径: 仅对 dry-run 报错的文件生成 Diff。clang-format 只输出替换列表
+    # (偏移量/长度/文本，通常只有几百字节)，而不是整个格式化后的文件
+    try:
+        output = run_clang_format(
+            ["-style=file", "--output-replacements-xml", file_path],
+            check=True, stdout=subprocess.PIPE
+        ).stdout
+    except subprocess.CalledProcessError:
+        return file_path, None, None
+
+    try:
+        replacements = sorted(
+            (int(r.get('offset')), int(r.get('length')), (r.text or '').encode('utf-8'))
+            for r in ElementTree.fromstring(output).iter('replacement')
+        )
+    except (ElementTree.ParseError, TypeError, ValueError):
+        # 替换文本按原样写入 XML，文件含非 UTF-8 字节 (例如 Latin-1 注释/路径) 时无法解析，
+        # 回退到获取完整格式化结果再逐字节对比
+        try:
+            return format_to_stdout(file_path)
+        except subprocess.CalledProcessError:
+            return file_path, None, None
+
+    if not replacements:
+        # 没有替换项: 文件格式正确，无需读取原始内容
+        return file_path, b'', b''
+
+    with open(file_path, 'rb') as f:
+        original_bytes = f.read()
+    return file_path, original_bytes, apply_replacements(original_bytes, replacements)
+
+def print_diff(file_path, original_bytes, formatted_bytes):
+    file = os.path.basename(file_path).encode('utf-8')
+    # 全程在 bytes 上生成 Diff，无需解码整个文件；拼好后一次性写出
+    diff = difflib.diff_bytes(
+        difflib.unified_diff,
+        original_bytes.splitlines(),
+        formatted_bytes.splitlines(),
+        fromfile=b'Current (' + file + b')',
+        tofile=b'Expected (' + file + b')',
+        lineterm=b''
+    )
+
+    buf = ["\n    >>> 差异详情:\n".encode('utf-8')]
+    for line in diff:
+        # 红色: 需要删除/修改的行 (当前代码)
+        # 绿色: 期望变成的样子 (格式化后)
+        # 青色: 头部信息 (@@ ... @@)
+        color = DIFF_COLORS.get(line[:1]) if USE_COLOR else None
+        if color:
+            buf.append(b"    " + color + line + b"\033[0m\n")
+        else:
+            buf.append(b"    " + line + b"\n")
+    buf.append(b"-" * 60 + b"\n")
+
+    # 与 print 共用 stdout，写 buffer 前后都要 flush 以保证输出顺序
+    sys.stdout.flush()
+    sys.stdout.buffer.write(b''.join(buf))
+    sys.stdout.buffer.flush()
 
-def check_format():
+def check_format(force=False, base=None, jobs=CPU_COUNT):
+    start_time = time.time()
     files_needing_format = []
     
     # 0. 打印版本信息，方便 CI 调试
     try:
-        version_output = subprocess.check_output(CLANG_FORMAT_CMD + ["--version"]).decode('utf-8')
+        version_output = clang_format_version()
         print(f"正在使用格式化工具: {CLANG_FORMAT_CMD[0]}")
-        print(f"工具版本: {version_output.strip()}")
+        print(f"工具版本: {version_output.decode('utf-8').strip()}")
     except Exception as e:
         print(f"错误: 无法执行 clang-format。")
         print(f"请确保已运行: pip install clang-format==19.1.0")
@@ -44,63 +187,58 @@ def check_format():
     print(f"正在检查代码格式 (基于 .clang-format)...")
     print("-" * 60)
     
-    for source_dir in SOURCE_DIRS:
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                if file.endswith(EXTENSIONS):
-                    file_path = os.path.join(root, file)
-                    
-                    try:
-                        # 1. 读取原始文件内容
-                        with open(file_path, 'rb') as f:
-                            original_bytes = f.read()
-                        
-                        # 2. 获取格式化后的内容 (不修改文件，只输出到 stdout)
-                        formatted_bytes = subprocess.check_output(
-                            CLANG_FORMAT_CMD + ["-style=file", file_path]
-                        )
-                        
-                        # 3. 对比
-                        if original_bytes != formatted_bytes:
-                            files_needing_format.append(file_path)
-                            print(f" [X] 格式错误: {file_path}")
-                            
-                            # =========================================
-                            # 生成并打印 Diff
-                            # =========================================
-                            try:
-                                original_text = original_bytes.decode('utf-8').splitlines()
-                                formatted_text = formatted_bytes.decode('utf-8').splitlines()
-                                
-                                diff = difflib.unified_diff(
-                                    original_text, 
-                                    formatted_text, 
-                                    fromfile=f'Current ({file})', 
-                                    tofile=f'Expected ({file})', 
-                                    lineterm=''
-                                )
-                                
-                                print("\n    >>> 差异详情:")
-                                for line in diff:
-                                    # 红色: 需要删除/修改的行 (当前代码)
-                                    if line.startswith('-'):
-                                        print(f"    \033[31m{line}\033[0m") 
-                                    # 绿色: 期望变成的样子 (格式化后)
-                                    elif line.startswith('+'):
-                                        print(f"    \033[32m{line}\033[0m")
-                                    # 头部信息 (@@ ... @@)
-                                    elif line.startswith('@'):
-                                        print(f"    \033[36m{line}\033[0m")
-                                    else:
-                                        print(f"    {line}")
-                                print("-" * 60)
-                            except Exception as e:
-                                print(f"    (无法生成 Diff，可能是编码问题: {e})")
-                                print("-" * 60)
-
-                    except subprocess.CalledProcessError:
-                        print(f"无法处理文件: {file_path}")
-                        sys.exit(1)
+    cfg_hash = config_hash(version_output)
+    cache = {} if force else load_cache()
+    last_run = 0 if force else load_last_run(cfg_hash)
+
+    # 在主线程中解析改动列表，失败时直接退出，而不是在生产者线程中被吞掉
+    files = changed_files(base) if base is not None else None
+    if files is not None:
+        print(f"仅检查相对 {base} 有改动的文件")
+    else:
+        if base is not None:
+            print(f"{CONFIG_FILE} 相对 {base} 有改动，回退到全量检查")
+        files = (
+            file_path
+            for source_dir in SOURCE_DIRS
+            for file_path in iter_sources(source_dir)
+        )
+
+    def sources():
+        # mtime 与 ctime 都不晚于上次成功运行的文件直接视为通过，无需读取和哈希
+        for file_path in files:
+            if modified_since(file_path, last_run):
+                yield file_path
+
+    # 1. 边遍历边分批 dry-run，clang-format 只对不合规的文件报错
+    digests = {}
+    suspects = []
+    for batch_digests, failed in run_pipeline(
+            sources(), lambda batch: check_batch(batch, cache, cfg_hash), jobs):
+        digests.update(batch_digests)
+        suspects.extend(failed)
+    suspects.sort()
+
+    # 2. 仅对报错的文件生成 Diff (按提交顺序取结果，输出顺序稳定)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for file_path, original_bytes, formatted_bytes in executor.map(check_file, suspects):
+            if formatted_bytes is None:
+                print(f"无法处理文件: {file_path}")
+                sys.exit(1)
+
+            if original_bytes != formatted_bytes:
+                files_needing_format.append(file_path)
+                print(f" [X] 格式错误: {file_path}")
+                print_diff(file_path, original_bytes, formatted_bytes)
+
+    failed_files = set(files_needing_format)
+    for file_path, digest in digests.items():
+        if file_path in failed_files:
+            cache.pop(file_path, None)
+        else:
+            cache[file_path] = digest
+
+    save_cache(cache)
 
     if files_needing_format:
         print("\n" + "="*60)
@@ -109,11 +247,30 @@ def check_format():
         print("="*60)
         sys.exit(1)
     else:
+        # 只检查了部分文件时不能推进时间戳，否则未检查的文件会被后续全量检查跳过
+        if base is None:
+            save_last_run(cfg_hash, start_time)
         print("\n" + "="*60)
         print("检查通过! 所有文件格式正确。")
         print("="*60)
         sys.exit(0)
 
 if __name__ == "__main__":
-    check_format()
+    parser = argparse.ArgumentParser(description="检查源代码是否符合 clang-format 规范")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略增量缓存和上次运行时间戳，检查所有文件")
+    parser.add_argument("--changed-only", nargs="?", const="origin/main", default=None,
+                        metavar="BASE",
+                        help="仅检查相对 BASE (默认 origin/main) 有改动的文件，适用于 PR 检查")
+    parser.add_argument("--color", choices=["auto", "always", "never"], default="auto",
+                        help="Diff 着色: auto 仅在输出到终端时着色 (默认)")
+    parser.add_argument("-j", "--jobs", type=int, default=CPU_COUNT, metavar="N",
+                        help=f"并行执行 clang-format 的任务数 (默认 CPU 核数 {CPU_COUNT})；"
+                             f"--jobs 1 即顺序执行，便于调试")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs 必须大于等于 1")
+    if args.color != "auto":
+        USE_COLOR = args.color == "always"
+    check_format(force=args.force, base=args.changed_only, jobs=args.jobs)
 
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# apply_format.py 与 check_format.py 共用的配置与工具函数
+import functools
+import hashlib
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# =================配置区域=================
+SOURCE_DIRS = ["src"]
+EXTENSIONS = (".cpp", ".h", ".hpp", ".cc", ".cxx")
+# 按扩展名 O(1) 查找，替代对元组逐个 endswith
+EXT_SET = frozenset(EXTENSIONS)
+# 默认并行任务数，可通过 --jobs 覆盖
+CPU_COUNT = os.cpu_count() or 1
+# 每次 clang-format 调用处理的文件数上限 (保持在 ARG_MAX 以内)
+BATCH_SIZE = 64
+# 文件遍历与 clang-format 之间的有界队列长度
+QUEUE_SIZE = 1024
+# 消费者攒批的等待时间 (秒)，超时即提交未满的批次
+FLUSH_TIMEOUT = 0.05
+# 增量缓存: 记录已确认格式正确的文件内容哈希
+CACHE_FILE = ".clang-format-cache.json"
+CONFIG_FILE = ".clang-format"
+# 上次成功运行的时间戳: mtime 与 ctime 都不晚于该时刻的文件直接跳过，无需读取和哈希
+LAST_RUN_FILE = ".clang-format-lastrun"
+# clang-format 版本缓存: 记录可执行文件路径、mtime 及 --version 输出
+VERSION_CACHE_FILE = ".clang-format-version.json"
+
+# ============================================================
+# 核心逻辑：动态查找当前 Python 环境下的 clang-format 可执行文件
+# ============================================================
+@functools.lru_cache(maxsize=1)
+def find_clang_format():
+    # 1. 获取当前 Python 解释器的目录 (例如 .../venv/bin)
+    bin_dir = os.path.dirname(sys.executable)
+
+    # 2. 拼接 clang-format 的路径
+    executable_name = "clang-format.exe" if os.name == 'nt' else "clang-format"
+    target_path = os.path.join(bin_dir, executable_name)
+
+    # 3. 如果存在 (pip 安装版)，就使用绝对路径；否则回退到系统 PATH
+    if os.path.exists(target_path):
+        return [target_path]
+    else:
+        # 解析为绝对路径，后续每次启动 clang-format 时无需再搜索 PATH
+        return [shutil.which("clang-format") or "clang-format"]
+
+CLANG_FORMAT_CMD = find_clang_format()
+
+def run_clang_format(args, **kwargs):
+    # 统一的 clang-format 启动入口: argv 列表 + 绝对路径，不使用 shell/preexec_fn/cwd，
+    # 且 close_fds=False (Python 3.4+ 的 fd 默认不可继承，PEP 446)，
+    # 满足这些条件时 CPython 会选用 posix_spawn (glibc 上即 vfork+exec)，省去 fork 复制页表的开销
+    return subprocess.run(CLANG_FORMAT_CMD + args, close_fds=False, **kwargs)
+
+def clang_format_version():
+    # 按可执行文件的路径和 mtime 缓存 --version 输出，工具未变化时无需再 fork/exec
+    path = CLANG_FORMAT_CMD[0]
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return run_clang_format(["--version"], check=True, stdout=subprocess.PIPE).stdout
+
+    try:
+        with open(VERSION_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached["path"] == path and cached["mtime"] == mtime:
+            return cached["version"].encode('utf-8')
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    version_output = run_clang_format(["--version"], check=True, stdout=subprocess.PIPE).stdout
+    try:
+        with open(VERSION_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"path": path, "mtime": mtime,
+                       "version": version_output.decode('utf-8')}, f)
+    except OSError:
+        pass
+    return version_output
+
+# ============================================================
+# 增量缓存: 内容哈希 = hash(配置哈希 + 文件内容)，命中则跳过该文件
+# ============================================================
+def new_hasher():
+    # 优先使用 xxhash (更快)，未安装时回退到标准库 blake2b
+    if xxhash is not None:
+        return xxhash.xxh64()
+    return hashlib.blake2b(digest_size=8)
+
+def config_hash(version_output):
+    # clang-format 版本或 .clang-format 变化时，所有缓存自动失效
+    h = new_hasher()
+    h.update(version_output)
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def file_hash(file_path, cfg_hash):
+    h = new_hasher()
+    h.update(cfg_hash.encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def load_cache():
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_cache(cache):
+    # 先写临时文件再原子替换，避免中断时留下损坏的缓存
+    tmp_path = CACHE_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, CACHE_FILE)
+
+def load_last_run(cfg_hash):
+    # 上次成功运行的时间戳；配置或工具版本变化时视为从未运行
+    try:
+        with open(LAST_RUN_FILE, 'r', encoding='utf-8') as f:
+            if f.read().strip() != cfg_hash:
+                return 0
+        return os.path.getmtime(LAST_RUN_FILE)
+    except OSError:
+        return 0
+
+def save_last_run(cfg_hash, start_time):
+    # 时间戳取本次运行开始时刻，运行期间被修改的文件下次仍会被处理
+    with open(LAST_RUN_FILE, 'w', encoding='utf-8') as f:
+        f.write(cfg_hash)
+    os.utime(LAST_RUN_FILE, (start_time, start_time))
+
+def modified_since(file_path, last_run):
+    # mv / cp -p / rsync -a / tar x / unzip 会保留旧的 mtime，但都会把 ctime 更新为当前时刻，
+    # 因此取两者较大值判断，这类文件仍会进入哈希检查而不会被跳过
+    st = os.stat(file_path)
+    return max(st.st_mtime, st.st_ctime) > last_run
+
+# ============================================================
+# 文件遍历与并行执行
+# ============================================================
+def iter_sources(root):
+    # os.scandir 返回的 DirEntry 自带文件类型信息，无需逐个 stat；以生成器形式边遍历边产出
+    try:
+        entries = os.scandir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        # 与 os.walk 一致: 不存在的目录 (例如不在仓库根目录下运行) 直接跳过
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_sources(entry.path)
+            elif entry.name[entry.name.rfind('.'):] in EXT_SET:
+                yield entry.path
+
+def run_pipeline(sources, handle_batch, jobs):
+    # 生产者线程遍历文件并写入有界队列，多个消费者线程按批取出并执行，
+    # 文件遍历与 clang-format 执行相互重叠，从一开始就让所有核心忙起来
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    results = []
+    errors = []
+
+    def produce():
+        try:
+            for item in sources:
+                q.put(item)
+        except BaseException as e:
+            # 包括 SystemExit/KeyboardInterrupt: 交由主线程重新抛出，不能在线程中静默结束
+            errors.append(e)
+        finally:
+            # 每个消费者各收到一个结束标记
+            for _ in range(jobs):
+                q.put(None)
+
+    def consume():
+        done = False
+        while not done:
+            item = q.get()
+            if item is None:
+                return
+            batch = [item]
+            # 攒批: 短暂等待更多文件，超时则先提交已取到的部分批次
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = q.get(timeout=FLUSH_TIMEOUT)
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            try:
+                results.append(handle_batch(batch))
+            except BaseException as e:
+                # 出错后继续消费队列，避免生产者阻塞在已满的队列上
+                errors.append(e)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=consume, daemon=True) for _ in range(jobs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results